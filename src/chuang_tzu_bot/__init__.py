@@ -1,7 +1,7 @@
 import os
 from typing import Iterable, Literal
 from dotenv import load_dotenv
-from contextlib import asynccontextmanager
+from contextlib import asynccontextmanager, nullcontext
 import asyncio
 from aiogram import Bot, Dispatcher, F
 from aiogram.enums import ParseMode
@@ -103,6 +103,7 @@ async def send_html_message(
 async def start_polling(
     bot_enviro: BotEnviro = "TEST",
     polling_timeout: int = 30,
+    record_path: str | None = None,
 ) -> None:
     bot = create_bot_client(bot_enviro)
     allowed_chat_ids = _get_allowed_chat_ids()
@@ -114,18 +115,28 @@ async def start_polling(
 
     dp.include_router(router)
 
+    recording = nullcontext()
+    if record_path:
+        from chuang_tzu_bot.record_replay import record_updates
+
+        recording = record_updates(record_path)
+
     print(f"Bot starting polling (env: {bot_enviro})")
     print(f"Allowed chats: {allowed_set}")
     print(f"Polling timeout: {polling_timeout}s")
+    if record_path:
+        print(f"Recording updates to: {record_path}")
 
     await bot.delete_webhook(drop_pending_updates=True)
 
     try:
-        await dp.start_polling(
-            bot,
-            polling_timeout=polling_timeout,
-            allowed_updates=["message"],
-        )
+        # Exiting this closes the log before the bot session shuts down
+        with recording:
+            await dp.start_polling(
+                bot,
+                polling_timeout=polling_timeout,
+                allowed_updates=["message"],
+            )
     finally:
         await dp.stop_polling()
         await asyncio.sleep(1)
@@ -0,0 +1,616 @@
+"""
+Record production traffic and replay it offline.
+
+Recording is opt-in: pass ``record_path`` to ``start_polling`` and every
+message a handler actually processed is appended to a gzip'd JSON-lines log
+together with the ``web_resources`` responses it triggered. Ids, names and
+usernames of chats and users are pseudonymised before anything is written.
+
+Replay feeds the log back through ``router`` with the backend stubbed from
+the recording and Telegram stubbed by a local session, then reports
+per-handler latency, bytes sent and errors:
+
+    python -m chuang_tzu_bot.record_replay updates.jsonl.gz --speed 10
+"""
+
+import argparse
+import asyncio
+import contextvars
+import gzip
+import hashlib
+import importlib
+import json
+import logging
+import math
+import os
+import sys
+import time
+import traceback
+import zlib
+from contextlib import contextmanager
+from typing import (
+    Any,
+    AsyncGenerator,
+    Awaitable,
+    Callable,
+    Dict,
+    Iterator,
+    List,
+    Optional,
+)
+
+from aiogram import BaseMiddleware, Bot, Dispatcher
+from aiogram.client.default import DefaultBotProperties
+from aiogram.client.session.base import BaseSession
+from aiogram.enums import ParseMode
+from aiogram.types import Message, TelegramObject, Update
+
+from chuang_tzu_bot import routes
+from chuang_tzu_bot.routes import router
+
+
+# web_resources functions that routes.py calls; these are the ones recorded
+# and later stubbed during replay.
+BACKEND_FUNCS = (
+    "check_master_health",
+    "enqueue_task",
+    "get_task_by_id",
+    "get_pending_tasks",
+    "get_running_tasks",
+    "get_failed_tasks",
+    "get_tasks_by_worker",
+)
+
+# Keys whose value is (or lists) a chat or person
+_PERSON_KEYS = {
+    "chat",
+    "from",
+    "sender_chat",
+    "sender_user",
+    "forward_from",
+    "forward_from_chat",
+    "forward_origin",
+    "origin",
+    "via_bot",
+    "user",
+    "left_chat_member",
+    "new_chat_members",
+    "contact",
+}
+# Inside a person: numeric ids are hashed, identifying text is pseudonymised.
+# "type" and "is_bot" are left alone; replay needs them to route the update.
+_ID_FIELDS = {"id", "user_id"}
+_NAME_FIELDS = {
+    "username",
+    "active_usernames",
+    "first_name",
+    "last_name",
+    "title",
+    "phone_number",
+    "vcard",
+    "sender_user_name",
+}
+
+# The log is flushed after this many records or seconds, whichever comes
+# first (checked on each write), so a crash loses at most one batch.
+FLUSH_EVERY = 50
+FLUSH_INTERVAL = 30.0
+
+# Gaps longer than this (seconds) between recorded updates, e.g. downtime
+# between two polling sessions in one log, are shortened to this on replay.
+DEFAULT_MAX_GAP = 60.0
+
+logger = logging.getLogger(__name__)
+
+_backend_calls: contextvars.ContextVar[Optional[List[list]]] = contextvars.ContextVar(
+    "backend_calls", default=None
+)
+_backend_misses: contextvars.ContextVar[Optional[List[str]]] = contextvars.ContextVar(
+    "backend_misses", default=None
+)
+_sent_bytes: contextvars.ContextVar[Optional[List[int]]] = contextvars.ContextVar(
+    "sent_bytes", default=None
+)
+
+
+class ReplayError(Exception):
+    """Raised when the log and the code under replay have diverged"""
+
+    pass
+
+
+@contextmanager
+def _patched_backend(
+    factory: Callable[[str, Callable[..., Awaitable[Any]]], Callable[..., Any]],
+) -> Iterator[None]:
+    """Swap the backend functions routes.py looks up for factory(name, original)."""
+    originals = {name: getattr(routes, name) for name in BACKEND_FUNCS}
+    for name, func in originals.items():
+        setattr(routes, name, factory(name, func))
+    try:
+        yield
+    finally:
+        for name, func in originals.items():
+            setattr(routes, name, func)
+
+
+@contextmanager
+def _mounted(*middlewares: BaseMiddleware) -> Iterator[Dispatcher]:
+    """
+    Attach router to a fresh Dispatcher with extra inner message middlewares,
+    and undo both on exit so the module-level router can be mounted again.
+    """
+    for middleware in middlewares:
+        router.message.middleware(middleware)
+    dp = Dispatcher()
+    dp.include_router(router)
+    try:
+        yield dp
+    finally:
+        dp.sub_routers.remove(router)
+        # aiogram has no public way to detach a router
+        router._parent_router = None
+        for middleware in middlewares:
+            router.message.middleware.unregister(middleware)
+
+
+def _exception_path(exc: BaseException) -> str:
+    return f"{type(exc).__module__}.{type(exc).__qualname__}"
+
+
+def _rebuild_exception(path: str, message: str) -> Exception:
+    """Recreate a recorded exception, falling back to RuntimeError."""
+    module_name, _, qualname = path.rpartition(".")
+    # qualname may itself be dotted (nested classes); walk back to a module
+    while module_name:
+        try:
+            obj: Any = importlib.import_module(module_name)
+            break
+        except ImportError:
+            module_name, _, head = module_name.rpartition(".")
+            qualname = f"{head}.{qualname}"
+    else:
+        return RuntimeError(f"{path}: {message}")
+
+    try:
+        for part in qualname.split("."):
+            obj = getattr(obj, part)
+        if isinstance(obj, type) and issubclass(obj, Exception):
+            return obj(message)
+    except Exception:
+        pass
+    return RuntimeError(f"{path}: {message}")
+
+
+def _recording(name: str, func: Callable[..., Awaitable[Any]]):
+    async def wrapper(*args, **kwargs):
+        calls = _backend_calls.get()
+        try:
+            result = await func(*args, **kwargs)
+        except Exception as e:
+            if calls is not None:
+                calls.append([name, None, _exception_path(e), str(e)])
+            raise
+        if calls is not None:
+            calls.append([name, result])
+        return result
+
+    return wrapper
+
+
+def _replaying(name: str, func: Callable[..., Awaitable[Any]]):
+    async def stub(*args, **kwargs):
+        calls = _backend_calls.get() or []
+        for i, call in enumerate(calls):
+            if call[0] == name:
+                del calls[i]
+                if len(call) > 2:
+                    raise _rebuild_exception(call[2], call[3])
+                return call[1]
+        # Handlers may swallow this (cmd_enq catches Exception), so note it
+        # where replay() can see it regardless
+        misses = _backend_misses.get()
+        if misses is not None:
+            misses.append(name)
+        raise ReplayError(f"No recorded response for {name}")
+
+    return stub
+
+
+class UpdateRecorder(BaseMiddleware):
+    """
+    Inner message middleware that appends each handled update and the
+    backend responses it triggered to a compressed, append-only log.
+
+    Being an inner middleware it only sees messages that passed the router
+    filters and matched a handler. start() opens the log and hooks the
+    backend; close() undoes both and flushes the gzip tail. Every run opens
+    a new gzip member, so one file can collect several sessions.
+
+    A failed write is logged and switches recording off; it never reaches
+    the handler.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._salt = os.urandom(16)
+        self._file = None
+        self._backend = None
+        self._unflushed = 0
+        self._flushed_at = 0.0
+
+    def start(self) -> None:
+        self._file = gzip.open(self.path, "at", encoding="utf-8")
+        self._flushed_at = time.monotonic()
+        self._backend = _patched_backend(_recording)
+        self._backend.__enter__()
+
+    def close(self) -> None:
+        try:
+            if self._backend is not None:
+                self._backend.__exit__(None, None, None)
+                self._backend = None
+        finally:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+    def _digest(self, value: Any) -> int:
+        digest = hashlib.blake2b(
+            str(value).encode(), key=self._salt, digest_size=6
+        ).digest()
+        return int.from_bytes(digest, "big")
+
+    def _redact_field(self, key: str, value: Any) -> Any:
+        if key in _ID_FIELDS and isinstance(value, int):
+            redacted = self._digest(value)
+            # Keep the sign so groups (negative ids) stay distinguishable
+            return -redacted if value < 0 else redacted
+        if key in _NAME_FIELDS:
+            if isinstance(value, str):
+                return f"x{self._digest(value):x}"
+            if isinstance(value, list):
+                return [f"x{self._digest(v):x}" for v in value]
+        return value
+
+    def _redact(self, obj: Any, person: bool = False) -> Any:
+        if isinstance(obj, dict):
+            out = {}
+            for key, value in obj.items():
+                if person and (key in _ID_FIELDS or key in _NAME_FIELDS):
+                    out[key] = self._redact_field(key, value)
+                else:
+                    out[key] = self._redact(value, person=key in _PERSON_KEYS)
+            return out
+        if isinstance(obj, list):
+            return [self._redact(v, person=person) for v in obj]
+        return obj
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: Dict[str, Any],
+    ) -> Any:
+        if self._file is None:
+            return await handler(event, data)
+
+        calls: List[list] = []
+        token = _backend_calls.set(calls)
+        received = time.time()
+        try:
+            return await handler(event, data)
+        finally:
+            _backend_calls.reset(token)
+            try:
+                self._write(data["event_update"], received, calls)
+            except Exception:
+                logger.exception("Update recording failed; recording disabled")
+                try:
+                    self.close()
+                except Exception:
+                    self._file = None
+
+    def _write(self, update: Update, received: float, calls: List[list]) -> None:
+        record = {
+            "ts": round(received, 3),
+            "update": self._redact(
+                update.model_dump(mode="json", exclude_none=True, by_alias=True)
+            ),
+            "backend": calls,
+        }
+        self._file.write(
+            json.dumps(record, separators=(",", ":"), ensure_ascii=False, default=str)
+            + "\n"
+        )
+        self._unflushed += 1
+        now = time.monotonic()
+        if self._unflushed >= FLUSH_EVERY or now - self._flushed_at >= FLUSH_INTERVAL:
+            self._file.flush()
+            self._unflushed = 0
+            self._flushed_at = now
+
+
+@contextmanager
+def record_updates(path: str) -> Iterator[UpdateRecorder]:
+    """
+    Record handled messages to path while the block runs.
+
+    The recorder is an inner router.message middleware, so it only sees
+    messages that passed the chat filter and matched a handler.
+    """
+    recorder = UpdateRecorder(path)
+    recorder.start()
+    try:
+        # Inner middleware: runs after the chat filter, only for handled messages
+        router.message.middleware(recorder)
+        try:
+            yield recorder
+        finally:
+            router.message.middleware.unregister(recorder)
+    finally:
+        recorder.close()
+
+
+def read_log(path: str) -> Iterator[Dict[str, Any]]:
+    """Yield records from a log, stopping cleanly at a truncated tail."""
+    with gzip.open(path, "rt", encoding="utf-8") as f:
+        try:
+            for line in f:
+                if line.strip():
+                    yield json.loads(line)
+        except (EOFError, zlib.error):
+            # Process was killed mid-write; everything before this is intact
+            return
+
+
+class ReplaySession(BaseSession):
+    """Bot session that answers locally and counts outgoing bytes."""
+
+    def __init__(self):
+        super().__init__()
+        self._message_id = 0
+
+    async def close(self) -> None:
+        pass
+
+    async def make_request(self, bot: Bot, method, timeout: int | None = None):
+        text = getattr(method, "text", None) or getattr(method, "caption", None)
+        sent = _sent_bytes.get()
+        if sent is not None and text:
+            sent[0] += len(text.encode())
+
+        chat_id = getattr(method, "chat_id", None)
+        if text is None or chat_id is None:
+            return True
+
+        self._message_id += 1
+        return Message.model_validate(
+            {
+                "message_id": self._message_id,
+                "date": int(time.time()),
+                "chat": {"id": chat_id, "type": "private"},
+                "text": text,
+            },
+            context={"bot": bot},
+        )
+
+    def stream_content(
+        self,
+        url: str,
+        headers: Optional[Dict[str, Any]] = None,
+        timeout: int = 30,
+        chunk_size: int = 65536,
+        raise_for_status: bool = True,
+    ) -> AsyncGenerator[bytes, None]:
+        raise ReplayError(f"Replay session cannot download files ({url})")
+
+
+class HandlerTimer(BaseMiddleware):
+    """Inner message middleware that times each handler and its sent bytes."""
+
+    def __init__(self):
+        self.samples: Dict[str, List[tuple[float, int]]] = {}
+        self.errors: Dict[str, Dict[str, int]] = {}
+        self.tracebacks: Dict[str, str] = {}
+        self.last_handler: Optional[str] = None
+        self.last_error: Optional[BaseException] = None
+
+    def count_error(self, name: str, key: str) -> None:
+        by_type = self.errors.setdefault(name, {})
+        by_type[key] = by_type.get(key, 0) + 1
+
+    def add_error(self, name: str, exc: BaseException) -> None:
+        self.last_error = exc
+        self.count_error(name, type(exc).__name__)
+        if name not in self.tracebacks:
+            self.tracebacks[name] = "".join(traceback.format_exception(exc))
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: Dict[str, Any],
+    ) -> Any:
+        name = data["handler"].callback.__name__
+        self.last_handler = name
+        sent = [0]
+        token = _sent_bytes.set(sent)
+        start = time.perf_counter()
+        try:
+            return await handler(event, data)
+        except Exception as e:
+            # Backend misses are counted by replay() as ReplayMiss, caught or not
+            if not (isinstance(e, ReplayError) and _backend_misses.get()):
+                self.add_error(name, e)
+            raise
+        finally:
+            elapsed = time.perf_counter() - start
+            _sent_bytes.reset(token)
+            self.samples.setdefault(name, []).append((elapsed, sent[0]))
+
+
+def _percentile(values: List[float], pct: float) -> float:
+    """Nearest-rank percentile."""
+    ordered = sorted(values)
+    return ordered[max(0, math.ceil(pct * len(ordered)) - 1)]
+
+
+async def replay(
+    path: str,
+    speed: float = 1.0,
+    max_gap: float = DEFAULT_MAX_GAP,
+    keep_going: bool = False,
+) -> Dict[str, Dict[str, Any]]:
+    """
+    Feed a recorded log back through the router.
+
+    speed scales the original inter-update gaps (1.0 = real time,
+    10 = ten times faster); speed <= 0 replays back-to-back. Gaps longer
+    than max_gap seconds are cut to max_gap so downtime between recorded
+    sessions is not slept through.
+
+    A backend call with no recorded response raises ReplayError, since the
+    log no longer matches the code; pass keep_going=True to count it as a
+    ReplayMiss against the handler and carry on. Returns per-handler stats
+    keyed by handler name, including error counts by type and the first
+    traceback seen.
+    """
+    timer = HandlerTimer()
+    bot = Bot(
+        token="42:REPLAY",
+        session=ReplaySession(),
+        default=DefaultBotProperties(parse_mode=ParseMode.HTML),
+    )
+
+    prev_ts: Optional[float] = None
+    offset = 0.0
+    started = time.monotonic()
+
+    try:
+        with _mounted(timer) as dp, _patched_backend(_replaying):
+            for record in read_log(path):
+                if speed > 0:
+                    if prev_ts is not None:
+                        offset += min(max(record["ts"] - prev_ts, 0.0), max_gap)
+                    prev_ts = record["ts"]
+                    delay = started + offset / speed - time.monotonic()
+                    if delay > 0:
+                        await asyncio.sleep(delay)
+
+                update = Update.model_validate(record["update"], context={"bot": bot})
+                misses: List[str] = []
+                timer.last_handler = None
+                calls_token = _backend_calls.set(list(record["backend"]))
+                misses_token = _backend_misses.set(misses)
+                try:
+                    await dp.feed_update(bot, update)
+                except Exception as e:
+                    missed = isinstance(e, ReplayError) and misses
+                    if not missed and e is not timer.last_error:
+                        # Raised outside a handler, so the timer missed it
+                        timer.add_error("<dispatch>", e)
+                finally:
+                    _backend_calls.reset(calls_token)
+                    _backend_misses.reset(misses_token)
+
+                if misses and not keep_going:
+                    raise ReplayError(
+                        f"Update {update.update_id}: no recorded response for "
+                        f"{', '.join(misses)}; the log does not match this build"
+                    )
+                for _ in misses:
+                    timer.count_error(timer.last_handler or "<dispatch>", "ReplayMiss")
+    finally:
+        await bot.session.close()
+
+    report: Dict[str, Dict[str, Any]] = {}
+    for name, samples in sorted(timer.samples.items()):
+        latencies = [s[0] * 1000 for s in samples]
+        sent = [s[1] for s in samples]
+        report[name] = {
+            "count": len(samples),
+            "p50_ms": _percentile(latencies, 0.50),
+            "p95_ms": _percentile(latencies, 0.95),
+            "max_ms": max(latencies),
+            "bytes_total": sum(sent),
+            "bytes_mean": sum(sent) / len(sent),
+            "errors": timer.errors.get(name, {}),
+            "first_traceback": timer.tracebacks.get(name),
+        }
+    if "<dispatch>" in timer.errors:
+        report["<dispatch>"] = {
+            "count": sum(timer.errors["<dispatch>"].values()),
+            "errors": timer.errors["<dispatch>"],
+            "first_traceback": timer.tracebacks.get("<dispatch>"),
+        }
+    return report
+
+
+def _print_report(report: Dict[str, Dict[str, Any]]) -> None:
+    header = f"{'handler':<20}{'count':>7}{'p50 ms':>10}{'p95 ms':>10}{'max ms':>10}{'bytes':>10}{'avg B':>9}"
+    print(header)
+    print("-" * len(header))
+    for name, s in report.items():
+        if "p50_ms" in s:
+            print(
+                f"{name:<20}{s['count']:>7}{s['p50_ms']:>10.2f}{s['p95_ms']:>10.2f}"
+                f"{s['max_ms']:>10.2f}{s['bytes_total']:>10}{s['bytes_mean']:>9.0f}"
+            )
+        else:
+            print(f"{name:<20}{s['count']:>7}")
+        for exc_name, count in s["errors"].items():
+            print(f"  ↳ {count} x {exc_name}")
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    parser = argparse.ArgumentParser(
+        description="Replay a recorded update log through the bot router"
+    )
+    parser.add_argument("log", help="path to a log written by UpdateRecorder")
+    parser.add_argument(
+        "--speed",
+        type=float,
+        default=1.0,
+        help="time scale for gaps between updates; 0 replays back-to-back",
+    )
+    parser.add_argument(
+        "--max-gap",
+        type=float,
+        default=DEFAULT_MAX_GAP,
+        help="cap in seconds on any single recorded gap, e.g. between sessions",
+    )
+    parser.add_argument(
+        "--keep-going",
+        action="store_true",
+        help="count backend calls missing from the log instead of stopping",
+    )
+    parser.add_argument(
+        "--json", action="store_true", help="print the report as JSON"
+    )
+    args = parser.parse_args(argv)
+
+    report = asyncio.run(
+        replay(
+            args.log,
+            speed=args.speed,
+            max_gap=args.max_gap,
+            keep_going=args.keep_going,
+        )
+    )
+    if args.json:
+        print(json.dumps(report, indent=2, ensure_ascii=False))
+    else:
+        _print_report(report)
+
+    first = next(
+        (s["first_traceback"] for s in report.values() if s["first_traceback"]),
+        None,
+    )
+    if first:
+        print("First replay error:", file=sys.stderr)
+        print(first, file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
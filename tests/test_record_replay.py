@@ -0,0 +1,224 @@
+import asyncio
+import gzip
+import json
+from contextlib import contextmanager
+
+import pytest
+
+pytest.importorskip("aiogram")
+pytest.importorskip("web_resources")
+
+from aiogram import Bot, F
+from aiogram.client.default import DefaultBotProperties
+from aiogram.enums import ParseMode
+from aiogram.types import Update
+
+from chuang_tzu_bot import routes
+from chuang_tzu_bot.record_replay import (
+    HandlerTimer,
+    ReplayError,
+    ReplaySession,
+    UpdateRecorder,
+    _mounted,
+    _percentile,
+    _rebuild_exception,
+    read_log,
+    record_updates,
+    replay,
+)
+from chuang_tzu_bot.routes import router
+
+
+ALICE = {
+    "id": 424242,
+    "is_bot": False,
+    "first_name": "Alice",
+    "last_name": "Liddell",
+    "username": "alice",
+}
+
+
+def _update(update_id: int, text: str, chat_id: int = 424242) -> dict:
+    return {
+        "update_id": update_id,
+        "message": {
+            "message_id": update_id,
+            "date": 1735725600,
+            "chat": {
+                "id": chat_id,
+                "type": "private",
+                "first_name": "Alice",
+                "username": "alice",
+            },
+            "from": ALICE,
+            "text": text,
+            "entities": [{"type": "text_mention", "offset": 0, "length": 1, "user": ALICE}],
+        },
+    }
+
+
+def _bot() -> Bot:
+    return Bot(
+        token="42:TEST",
+        session=ReplaySession(),
+        default=DefaultBotProperties(parse_mode=ParseMode.HTML),
+    )
+
+
+async def _record(path: str, updates: list[dict]) -> HandlerTimer:
+    """Feed updates through the same recording hook start_polling uses."""
+    timer = HandlerTimer()
+    bot = _bot()
+    try:
+        with _mounted(timer) as dp, record_updates(path) as recorder:
+            for raw in updates:
+                update = Update.model_validate(raw, context={"bot": bot})
+                await dp.feed_update(bot, update)
+    finally:
+        await bot.session.close()
+    assert recorder not in router.message.middleware[:]
+    return timer
+
+
+@contextmanager
+def _chat_filter(monkeypatch, allowed: set[int]):
+    """Apply start_polling's chat filter for the duration of the block."""
+    with monkeypatch.context() as m:
+        m.setattr(
+            router.message._handler,
+            "filters",
+            list(router.message._handler.filters or []),
+        )
+        router.message.filter(F.chat.id.in_(allowed))
+        yield
+
+
+@pytest.fixture
+def backend(monkeypatch):
+    async def get_pending_tasks():
+        return [
+            {
+                "id": 7,
+                "name": "scrape",
+                "created_at": "2025-01-01T10:00:00",
+                "device": "cpu",
+            }
+        ]
+
+    monkeypatch.setattr(routes, "get_pending_tasks", get_pending_tasks)
+
+
+def test_record_then_replay_round_trip(tmp_path, backend, monkeypatch):
+    path = str(tmp_path / "updates.jsonl.gz")
+    updates = [
+        _update(1, "/pending"),
+        _update(2, "hello"),
+        _update(3, "/pending", chat_id=-1001),
+    ]
+    with _chat_filter(monkeypatch, {424242}):
+        recorded = asyncio.run(_record(path, updates))
+
+    with gzip.open(path, "rt", encoding="utf-8") as f:
+        raw = f.read()
+    for secret in ("424242", "alice", "Alice", "Liddell"):
+        assert secret not in raw
+
+    # "hello" matches no handler and chat -1001 is filtered out
+    records = list(read_log(path))
+    assert len(records) == 1
+    assert [call[0] for call in records[0]["backend"]] == ["get_pending_tasks"]
+    message = records[0]["update"]["message"]
+    assert message["chat"]["type"] == "private"
+    assert message["from"]["is_bot"] is False
+
+    report = asyncio.run(replay(path, speed=0))
+    assert list(report) == ["cmd_pending"]
+    assert report["cmd_pending"]["count"] == 1
+    assert report["cmd_pending"]["errors"] == {}
+    recorded_bytes = sum(sent for _, sent in recorded.samples["cmd_pending"])
+    assert report["cmd_pending"]["bytes_total"] == recorded_bytes > 0
+
+    # replay() detaches the router, so it can run again in the same process
+    assert asyncio.run(replay(path, speed=0))["cmd_pending"]["count"] == 1
+
+
+def test_replay_fails_when_log_diverges(tmp_path):
+    path = str(tmp_path / "updates.jsonl.gz")
+    with gzip.open(path, "wt", encoding="utf-8") as f:
+        record = {"ts": 0, "update": _update(1, "/queue"), "backend": []}
+        f.write(json.dumps(record) + "\n")
+
+    with pytest.raises(ReplayError):
+        asyncio.run(replay(path, speed=0))
+
+    report = asyncio.run(replay(path, speed=0, keep_going=True))
+    assert report["cmd_queue"]["errors"] == {"ReplayMiss": 1}
+
+
+def test_keep_going_counts_misses_the_handler_swallowed(tmp_path, capsys):
+    path = str(tmp_path / "updates.jsonl.gz")
+    # cmd_enq catches Exception, so the ReplayError never leaves the handler
+    text = '/enq scrape --data {"url":"x"}'
+    with gzip.open(path, "wt", encoding="utf-8") as f:
+        record = {"ts": 0, "update": _update(1, text), "backend": []}
+        f.write(json.dumps(record) + "\n")
+
+    with pytest.raises(ReplayError):
+        asyncio.run(replay(path, speed=0))
+
+    report = asyncio.run(replay(path, speed=0, keep_going=True))
+    assert report["cmd_enq"]["count"] == 1
+    assert report["cmd_enq"]["errors"] == {"ReplayMiss": 1}
+    assert capsys.readouterr().err == ""
+
+
+def test_failed_write_disables_recording_not_the_handler(tmp_path):
+    class BrokenFile:
+        def write(self, _):
+            raise OSError("disk full")
+
+        def close(self):
+            pass
+
+    recorder = UpdateRecorder(str(tmp_path / "updates.jsonl.gz"))
+    recorder.start()
+    recorder._file = BrokenFile()
+    update = Update.model_validate(_update(1, "/pending"))
+
+    async def handler(event, data):
+        return "handled"
+
+    result = asyncio.run(recorder(handler, update.message, {"event_update": update}))
+    assert result == "handled"
+    assert recorder._file is None
+    assert recorder._backend is None
+
+
+def test_log_is_flushed_before_close(tmp_path, backend, monkeypatch):
+    monkeypatch.setattr("chuang_tzu_bot.record_replay.FLUSH_EVERY", 1)
+    path = tmp_path / "updates.jsonl.gz"
+    recorder = UpdateRecorder(str(path))
+    recorder.start()
+    update = Update.model_validate(_update(1, "/pending"))
+
+    async def handler(event, data):
+        return None
+
+    asyncio.run(recorder(handler, update.message, {"event_update": update}))
+    # Snapshot as if the process were killed before close()
+    crashed = tmp_path / "crashed.jsonl.gz"
+    crashed.write_bytes(path.read_bytes())
+    recorder.close()
+    assert len(list(read_log(str(crashed)))) == 1
+
+
+def test_percentile_is_nearest_rank():
+    assert _percentile([1.0, 2.0], 0.50) == 1.0
+    assert _percentile([float(i) for i in range(1, 21)], 0.95) == 19.0
+    assert _percentile([5.0], 0.95) == 5.0
+
+
+def test_recorded_exception_keeps_its_type():
+    assert isinstance(_rebuild_exception("builtins.ValueError", "bad"), ValueError)
+    fallback = _rebuild_exception("not_a_module.Missing", "gone")
+    assert type(fallback) is RuntimeError